@@ -1,13 +1,23 @@
 import os
+import io
 import json
+import functools
 import hydra
 from hydra.core.config_store import ConfigStore
 from dataclasses import dataclass, field
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 import tiktoken
 import logging
 import traceback
-import shutil
+import mmap
+import sqlite3
+import hashlib
+import string
+from contextlib import ExitStack
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat, islice
+from collections import deque
 
 # --- Optional Dependencies ---
 try:
@@ -20,6 +30,7 @@ except ImportError:
 try:
     import pytesseract
     from pdf2image import convert_from_path
+    from PIL import Image, ImageOps
 
     OCR_ENABLED = True
 except ImportError:
@@ -28,7 +39,17 @@ except ImportError:
 try:
     from ebooklib import epub
     import ebooklib
-    from bs4 import BeautifulSoup
+
+    # Prefer selectolax's C HTML parser; fall back to BeautifulSoup when it is not installed
+    try:
+        from selectolax.lexbor import LexborHTMLParser as HTMLParser
+    except ImportError:
+        try:
+            from selectolax.parser import HTMLParser
+        except ImportError:
+            HTMLParser = None
+    if HTMLParser is None:
+        from bs4 import BeautifulSoup, FeatureNotFound
 
     EPUBCSS_ENABLED = True
 except ImportError:
@@ -44,12 +65,55 @@ except ImportError:
 try:
     from reportlab.pdfgen import canvas
     from reportlab.lib.pagesizes import letter
-    from reportlab.lib.utils import simpleSplit
+    from reportlab.pdfbase.pdfmetrics import stringWidth
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
 
     REPORTLAB_ENABLED = True
 except ImportError:
     REPORTLAB_ENABLED = False
 
+try:
+    import pikepdf
+
+    PIKEPDF_ENABLED = True
+except ImportError:
+    PIKEPDF_ENABLED = False
+
+try:
+    import xxhash
+
+    XXHASH_ENABLED = True
+except ImportError:
+    XXHASH_ENABLED = False
+
+try:
+    import orjson
+
+    ORJSON_ENABLED = True
+except ImportError:
+    ORJSON_ENABLED = False
+
+try:
+    from tokenizers import Tokenizer
+
+    TOKENIZERS_ENABLED = True
+except ImportError:
+    TOKENIZERS_ENABLED = False
+
+# Maximum number of page images handed to a single Tesseract invocation
+OCR_BATCH_SIZE = 160
+# Rasterization resolution for OCR; 150 DPI grayscale is enough for body text and much lighter than 200 DPI RGB
+OCR_DPI = 150
+# Content-stream bytes per token used to estimate native PDF page tokens without extracting text.
+# Deliberately low (text operators add overhead) so estimates err on the high side.
+CONTENT_BYTES_PER_TOKEN = 4
+# Part of every cache key; bump it whenever extraction, OCR preprocessing or PDF conversion output changes
+CACHE_VERSION = 1
+
+# Name under which the configured TrueType font is registered with reportlab
+UNICODE_FONT_NAME = "DejaVu"
+
 # --- Setup Logging ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -65,6 +129,28 @@ class AppConfig:
     tiktoken_model: str
     use_ocr: bool
     file_types: List[str] = field(default_factory=list)
+    tokenizer_backend: str = "tiktoken"
+    hf_tokenizer: str = "Xenova/gpt-4o"
+    poppler_path: Optional[str] = None
+    tesseract_cmd: Optional[str] = None
+    tesseract_config: Optional[str] = "--oem 1"
+    workers: Optional[int] = None
+    estimate_native_tokens: bool = False
+    font_path: Optional[str] = "DejaVuSans.ttf"
+    cache_path: Optional[str] = None
+
+
+@dataclass
+class PreparedFile:
+    """Result of the per-file extraction stage, handed back from a worker to the batching loop."""
+    filename: str
+    pdf_path: Optional[str] = None
+    pdf_bytes: Optional[bytes] = None
+    page_texts: List[Optional[str]] = field(default_factory=list)  # None where the token count is an estimate
+    page_tokens: List[int] = field(default_factory=list)
+    skip_reason: Optional[str] = None
+    cache_key: Optional[str] = None
+    from_cache: bool = False
 
 
 cs = ConfigStore.instance()
@@ -73,8 +159,19 @@ cs.store(name="app_config", node=AppConfig)
 
 # --- Text Extraction and File Processing Functions ---
 
-def extract_text_from_file(file_path: str, cfg: AppConfig) -> str:
-    """Extracts text from various file types to be converted into a temporary PDF."""
+def _html_to_text(html: bytes) -> str:
+    """Extracts the visible text of an HTML document, one block per line."""
+    if HTMLParser is not None:
+        body = HTMLParser(html).body
+        return body.text(separator='\n') if body is not None else ""
+    try:
+        return BeautifulSoup(html, 'lxml').get_text(separator='\n')
+    except FeatureNotFound:  # lxml is not installed
+        return BeautifulSoup(html, 'html.parser').get_text(separator='\n')
+
+
+def extract_text_from_file(file_path: str, cfg: AppConfig, threads: int = 1) -> str:
+    """Extracts text from various file types to be converted into an in-memory PDF."""
     ext = os.path.splitext(file_path)[1].lower()
     text = ""
     try:
@@ -82,7 +179,7 @@ def extract_text_from_file(file_path: str, cfg: AppConfig) -> str:
             if not EPUBCSS_ENABLED: return ""
             book = epub.read_epub(file_path)
             items = [item.get_content() for item in book.get_items() if item.get_type() == ebooklib.ITEM_DOCUMENT]
-            text = "\n\n".join([BeautifulSoup(item, 'html.parser').get_text(separator='\n') for item in items])
+            text = "\n\n".join([_html_to_text(item) for item in items])
         elif ext == '.docx':
             if not DOCX_ENABLED: return ""
             doc = docx.Document(file_path)
@@ -91,39 +188,170 @@ def extract_text_from_file(file_path: str, cfg: AppConfig) -> str:
             with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
                 text = f.read()
         elif ext == '.pdf':  # For scanned PDFs
-            print(ext)
             if not OCR_ENABLED: return ""
-            # Set Tesseract command if specified in config
-            if cfg.tesseract_cmd:
-                pytesseract.pytesseract.tesseract_cmd = cfg.tesseract_cmd
-            logging.info(f"Performing OCR on {os.path.basename(file_path)}...")
-            images = convert_from_path(file_path, poppler_path="/opt/homebrew/opt/poppler/bin", fmt='jpg')
-            # convert images to grayscale for better OCR results
-            print("Converting PDF to images for OCR...")
-            text = "".join(pytesseract.image_to_string(img) for img in images)
+            text = perform_ocr(file_path, cfg, threads)
     except Exception as e:
         logging.error(f"Error extracting text from {file_path}: {e}")
     return text
 
 
+def _init_ocr_worker(tesseract_cmd):
+    """Configures pytesseract inside each OCR worker process."""
+    if tesseract_cmd:
+        pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+    # Each tesseract child gets one core from our budget; stop it from spawning its own OpenMP threads
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+
+def _otsu_threshold(img) -> int:
+    """Computes Otsu's binarization threshold from a grayscale image's histogram."""
+    hist = img.histogram()[:256]
+    total = sum(hist)
+    sum_all = sum(i * h for i, h in enumerate(hist))
+    sum_bg, weight_bg, best_var, threshold = 0, 0, -1.0, 0
+    for i, h in enumerate(hist):
+        weight_bg += h
+        if weight_bg == 0:
+            continue
+        weight_fg = total - weight_bg
+        if weight_fg == 0:
+            break
+        sum_bg += i * h
+        mean_diff = sum_bg / weight_bg - (sum_all - sum_bg) / weight_fg
+        between_var = weight_bg * weight_fg * mean_diff * mean_diff
+        if between_var > best_var:
+            best_var, threshold = between_var, i
+    return threshold
+
+
+def _preprocess_page(image_path: str) -> str:
+    """Autocontrasts and binarizes a grayscale page image for Tesseract. Returns the path of the result."""
+    with Image.open(image_path) as img:
+        img = ImageOps.autocontrast(img.convert('L'))
+    threshold = _otsu_threshold(img)
+    bw = img.point([255 if i > threshold else 0 for i in range(256)], mode='1')
+    # Bilevel images compress well as CCITT G4 TIFF, which Tesseract reads natively
+    bw_path = os.path.splitext(image_path)[0] + ".tif"
+    bw.save(bw_path, compression='group4')
+    return bw_path
+
+
+def _ocr_pages(image_paths: List[str], tesseract_config: str = "") -> str:
+    """Runs a single Tesseract process over a batch of page images. Executed in a worker process."""
+    image_paths = [_preprocess_page(image_path) for image_path in image_paths]
+    # Tesseract accepts a text file listing one image per line, which avoids one subprocess per page
+    list_path = os.path.splitext(image_paths[0])[0] + "_batch.txt"
+    with open(list_path, 'w') as f:
+        f.write("\n".join(image_paths))
+    return pytesseract.image_to_string(list_path, config=tesseract_config)
+
+
+def perform_ocr(file_path: str, cfg: AppConfig, workers: int = 1) -> str:
+    """Rasterizes a scanned PDF and OCRs batches of pages on `workers` cores in parallel, preserving page order."""
+    tesseract_cmd = cfg.tesseract_cmd
+    logging.info(f"Performing OCR on {os.path.basename(file_path)}...")
+    with tempfile.TemporaryDirectory() as image_dir:
+        # Pages are written to disk so workers receive paths instead of pickled PIL images
+        image_paths = convert_from_path(file_path, dpi=OCR_DPI, grayscale=True, thread_count=workers,
+                                        poppler_path=cfg.poppler_path, fmt='jpeg', output_folder=image_dir,
+                                        paths_only=True)
+        if not image_paths:
+            return ""
+        # Spread pages over all workers, but never hand a single Tesseract call more than OCR_BATCH_SIZE pages
+        batch_size = max(1, min(OCR_BATCH_SIZE, -(-len(image_paths) // workers)))
+        batches = [image_paths[i:i + batch_size] for i in range(0, len(image_paths), batch_size)]
+        if workers == 1:
+            # No spare cores in this file worker: run the batches here instead of starting a nested pool
+            _init_ocr_worker(tesseract_cmd)
+            texts = [_ocr_pages(batch, cfg.tesseract_config or "") for batch in batches]
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_ocr_worker,
+                                     initargs=(tesseract_cmd,)) as ex:
+                texts = list(ex.map(_ocr_pages, batches, repeat(cfg.tesseract_config or "")))
+    return "".join(texts)
+
+
 # --- PDF Creation and Merging ---
 
-def create_pdf_from_text(text: str, output_path: str):
-    """Creates a new searchable PDF file from a string of text."""
+def open_pdf_reader(file_path: str) -> "PdfReader":
+    """Opens a PDF through a read-only memory map so pypdf's xref seeks don't each cost a read syscall."""
+    with open(file_path, 'rb') as f:
+        try:
+            # The map keeps its own handle, so the file object can be closed right away
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # Empty files cannot be mapped
+            return PdfReader(file_path)
+    return PdfReader(mm)
+
+
+@functools.lru_cache(maxsize=None)
+def _register_unicode_font(font_path: str) -> Optional[str]:
+    """Registers a TrueType font with reportlab once per process. Returns its name, or None if it can't be loaded."""
+    try:
+        pdfmetrics.registerFont(TTFont(UNICODE_FONT_NAME, font_path))
+        return UNICODE_FONT_NAME
+    except Exception as e:
+        logging.warning(f"Could not load font '{font_path}', falling back to Helvetica (Latin-1 only): {e}")
+        return None
+
+
+class _GlyphWidths(dict):
+    """Per-character advance widths for one font and size, measured once and filled in lazily."""
+
+    def __init__(self, font_name: str, font_size: float):
+        super().__init__()
+        self.font_name, self.font_size = font_name, font_size
+        self.update((ch, stringWidth(ch, font_name, font_size)) for ch in string.printable)
+
+    def __missing__(self, ch: str) -> float:
+        width = self[ch] = stringWidth(ch, self.font_name, self.font_size)
+        return width
+
+
+@functools.lru_cache(maxsize=8)
+def _get_glyph_widths(font_name: str, font_size: float) -> _GlyphWidths:
+    """Returns the shared glyph width table for a font and size."""
+    return _GlyphWidths(font_name, font_size)
+
+
+def _wrap_line(line: str, max_width: float, widths: _GlyphWidths) -> List[str]:
+    """Greedy word wrap with cached glyph widths; same line breaks as reportlab's simpleSplit."""
+    wrapped, words = [], []
+    space = widths[' ']
+    line_width = -space
+    for word in line.split():
+        word_width = sum(widths[ch] for ch in word)
+        if line_width + space + word_width <= max_width or not words:
+            words.append(word)
+            line_width += space + word_width
+        else:
+            wrapped.append(' '.join(words))
+            words, line_width = [word], word_width
+    if words:
+        wrapped.append(' '.join(words))
+    return wrapped
+
+
+def create_pdf_from_text(text: str, output, font_path: Optional[str] = None):
+    """Creates a new searchable PDF from a string of text, written to a file path or a binary buffer."""
     if not REPORTLAB_ENABLED:
-        logging.error(f"Cannot create PDF for {output_path}, 'reportlab' is not installed.")
+        logging.error(f"Cannot create PDF for {output}, 'reportlab' is not installed.")
         return
     try:
-        c = canvas.Canvas(output_path, pagesize=letter)
+        c = canvas.Canvas(output, pagesize=letter)
         width, height = letter
-        margin, font_name, font_size = 72, "Helvetica", 10
+        unicode_font = _register_unicode_font(font_path) if font_path else None
+        margin, font_name, font_size = 72, unicode_font or "Helvetica", 10
         text_width = width - 2 * margin
+        widths = _get_glyph_widths(font_name, font_size)
         c.setFont(font_name, font_size)
 
         text_object = c.beginText(margin, height - margin)
         for line in text.splitlines():
-            line = line.encode('latin-1', 'replace').decode('latin-1')
-            wrapped = simpleSplit(line, font_name, font_size, text_width) or ['']
+            if not unicode_font:
+                # The built-in Helvetica font only covers Latin-1
+                line = line.encode('latin-1', 'replace').decode('latin-1')
+            wrapped = _wrap_line(line, text_width, widths) or ['']
             for wrapped_line in wrapped:
                 text_object.textLine(wrapped_line)
                 if text_object.getY() < margin:
@@ -134,39 +362,342 @@ def create_pdf_from_text(text: str, output_path: str):
         c.drawText(text_object)
         c.save()
     except Exception as e:
-        logging.error(f"Failed to write PDF file {output_path}: {e}\n{traceback.format_exc()}")
+        logging.error(f"Failed to write PDF file {output}: {e}\n{traceback.format_exc()}")
 
 
 # --- Core Logic ---
 
+@functools.lru_cache(maxsize=8)
+def _get_encoding(model: str):
+    """Loads the tiktoken encoding for a model once and reuses it across calls."""
+    return tiktoken.encoding_for_model(model)
+
+
 def count_tokens(text: str, model: str) -> int:
     """Counts tokens using tiktoken."""
     try:
-        return len(tiktoken.encoding_for_model(model).encode(text))
+        return len(_get_encoding(model).encode_ordinary(text))
     except Exception:
         return 0
 
 
-def finalize_batch(writer, tokens, sources, size, count, cfg, report):
+def count_tokens_batch(texts: List[str], model: str, num_threads: int = 1) -> List[int]:
+    """Counts tokens for many texts at once; tiktoken tokenizes the batch in parallel outside the GIL."""
+    try:
+        return [len(ids) for ids in _get_encoding(model).encode_ordinary_batch(texts, num_threads=num_threads)]
+    except Exception:
+        return [count_tokens(text, model) for text in texts]
+
+
+@functools.lru_cache(maxsize=8)
+def _get_hf_tokenizer(name: str):
+    """Loads a HuggingFace tokenizer once and reuses it across calls."""
+    return Tokenizer.from_pretrained(name)
+
+
+def count_page_tokens(texts: List[str], cfg: AppConfig, threads: int = 1) -> List[int]:
+    """Counts tokens per page with the configured backend ('tiktoken', 'tokenizers' or 'heuristic')."""
+    backend = cfg.tokenizer_backend
+    if backend == "heuristic":
+        # Rough estimate for the batch-fit decision; finalized batches are re-counted with tiktoken.
+        return [len(text) // 4 for text in texts]
+    if backend == "tokenizers":
+        if TOKENIZERS_ENABLED:
+            try:
+                return [len(enc.ids) for enc in _get_hf_tokenizer(cfg.hf_tokenizer).encode_batch(texts)]
+            except Exception as e:
+                logging.error(f"Tokenizer '{cfg.hf_tokenizer}' failed, falling back to tiktoken: {e}")
+        else:
+            logging.error("tokenizer_backend is 'tokenizers' but the package is not installed. Using tiktoken.")
+    return count_tokens_batch(texts, cfg.tiktoken_model, threads)
+
+
+def _page_runs(indices: List[int]) -> List[Tuple[int, int]]:
+    """Collapses sorted page indices into half-open (start, end) ranges of consecutive pages."""
+    runs = []
+    for i in indices:
+        if runs and runs[-1][1] == i:
+            runs[-1] = (runs[-1][0], i + 1)
+        else:
+            runs.append((i, i + 1))
+    return runs
+
+
+def write_batch_pdf(pages: List[Tuple[object, List[int]]], output_path: str):
+    """Merges (source, page_indices) groups into one PDF; a source is a file path or in-memory PDF bytes."""
+    # Sources are closed as soon as the output is written; they must stay open until then
+    with ExitStack() as stack:
+        if PIKEPDF_ENABLED:
+            # qpdf copies content streams natively
+            out = stack.enter_context(pikepdf.Pdf.new())
+            for source, indices in pages:
+                src = stack.enter_context(pikepdf.Pdf.open(io.BytesIO(source) if isinstance(source, bytes) else source))
+                for start, end in _page_runs(indices):
+                    out.pages.extend(src.pages[start:end])
+            out.save(output_path)
+        else:
+            writer = PdfWriter()
+            for source, indices in pages:
+                reader = PdfReader(io.BytesIO(source)) if isinstance(source, bytes) else open_pdf_reader(source)
+                stack.callback(reader.stream.close)
+                for start, end in _page_runs(indices):
+                    writer.append(reader, pages=(start, end), import_outline=False)
+            with open(output_path, "wb") as out_file:
+                writer.write(out_file)
+
+
+def finalize_batch(pages, tokens, sources, texts, size, count, cfg, report, threads=1):
     """Helper function to write a completed batch to a file and update the report."""
-    if not writer.pages:
-        return PdfWriter(), 0, [], 0  # Return empty state if there's nothing to write
+    if not pages:
+        return [], 0, {}, [], 0  # Return empty state if there's nothing to write
 
     output_filename = f"knowledge_base_{count}.pdf"
     output_path = os.path.join(cfg.output_directory, output_filename)
 
-    with open(output_path, "wb") as out_file:
-        writer.write(out_file)
+    write_batch_pdf(pages, output_path)
 
     final_size_mb = os.path.getsize(output_path) / (1024 * 1024)
+    estimated_tokens = sum(n for text, n in texts if text is None)
+    if estimated_tokens:
+        logging.warning(
+            f"Batch {count}: {estimated_tokens} of {tokens} tokens are content-stream estimates "
+            f"(estimate_native_tokens). The true count may differ and can exceed max_tokens_per_file.")
+    if cfg.tokenizer_backend == "heuristic":
+        # Report exact counts even though the batch was packed using estimates.
+        # Pages estimated from their content stream have no text and keep their estimate.
+        exact = count_tokens_batch([text for text, _ in texts if text is not None], cfg.tiktoken_model, threads)
+        tokens = sum(exact) + estimated_tokens
+        if tokens > cfg.max_tokens_per_file:
+            logging.warning(
+                f"Batch {count}: exact count of {tokens} tokens exceeds max_tokens_per_file "
+                f"({cfg.max_tokens_per_file}); the heuristic backend underestimated this text.")
     report["merged_files"].append({
         "output_file": output_filename,
-        "source_files": sorted(list(set(sources))),
+        "source_files": sorted(sources),
         "total_tokens": tokens,
         "total_size_mb": round(final_size_mb, 2)
     })
     logging.info(f"Finalized batch {count} as {output_filename} ({tokens} tokens, {final_size_mb:.2f} MB)")
-    return PdfWriter(), 0, [], 0
+    return [], 0, {}, [], 0
+
+
+def _extract_page_text(page, filename: str, page_index: int) -> str:
+    """Extracts one page's text, logging and returning an empty string if pypdf fails on that page."""
+    try:
+        return page.extract_text() or ""
+    except Exception as e:
+        logging.warning(f"Could not extract text from page {page_index + 1} of '{filename}': {e}")
+        return ""
+
+
+def _page_may_have_text(page) -> bool:
+    """Cheap structural check: a page with neither fonts nor Form XObjects has no text layer (e.g. a scan)."""
+    resources = page.get('/Resources')
+    if resources is None:
+        return False
+    resources = resources.get_object()
+    if '/Font' in resources:
+        return True
+    # Imposed pages and stamped text layers keep their fonts inside Form XObjects, which extract_text walks
+    xobjects = resources.get('/XObject')
+    if xobjects is None:
+        return False
+    return any(xobject.get_object().get('/Subtype') == '/Form' for xobject in xobjects.get_object().values())
+
+
+def _form_xobjects_size(resources, seen: set) -> int:
+    """Total decoded size of the Form XObjects reachable from a resources dictionary, each counted once."""
+    xobjects = resources.get('/XObject') if resources is not None else None
+    if xobjects is None:
+        return 0
+    size = 0
+    for ref in xobjects.get_object().values():
+        key = getattr(ref, 'idnum', None) or id(ref)
+        xobject = ref.get_object()
+        if key in seen or xobject.get('/Subtype') != '/Form':
+            continue
+        seen.add(key)
+        size += len(xobject.get_data())
+        nested = xobject.get('/Resources')
+        size += _form_xobjects_size(nested.get_object() if nested is not None else None, seen)
+    return size
+
+
+def _estimate_page_tokens(page) -> int:
+    """Approximates a page's token count from the size of its content stream (and the Form XObjects it can
+    draw), without interpreting it."""
+    contents = page.get_contents()
+    size = len(contents.get_data()) if contents is not None else 0
+    resources = page.get('/Resources')
+    size += _form_xobjects_size(resources.get_object() if resources is not None else None, set())
+    return size // CONTENT_BYTES_PER_TOKEN
+
+
+# --- Preparation Cache ---
+
+def hash_file(file_path: str) -> str:
+    """Hashes a file's contents with xxh3 (or BLAKE2b when xxhash is not installed)."""
+    with open(file_path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # Empty files cannot be mapped
+            data = b""
+        try:
+            return xxhash.xxh3_64_hexdigest(data) if XXHASH_ENABLED else hashlib.blake2b(data).hexdigest()
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+
+def _cache_key(file_path: str, cfg: AppConfig) -> str:
+    """Builds a cache key from the file contents and every setting that changes the prepared result."""
+    settings = (CACHE_VERSION, OCR_DPI, CONTENT_BYTES_PER_TOKEN, cfg.tokenizer_backend, cfg.tiktoken_model,
+                cfg.hf_tokenizer, cfg.estimate_native_tokens, cfg.font_path, cfg.use_ocr, cfg.tesseract_cmd,
+                cfg.tesseract_config)
+    return hash_file(file_path) + ":" + hashlib.blake2b(repr(settings).encode(), digest_size=8).hexdigest()
+
+
+def open_cache(cache_path: str) -> sqlite3.Connection:
+    """Opens (and creates if needed) the SQLite cache of prepared files."""
+    if os.path.dirname(cache_path):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    conn = sqlite3.connect(cache_path, timeout=30)
+    # WAL lets worker processes read while the main process writes
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS prepared_files ("
+                 "key TEXT PRIMARY KEY, page_tokens TEXT, page_texts TEXT, pdf BLOB, is_native INTEGER)")
+    return conn
+
+
+def load_cached_file(cache_path: str, key: str, filename: str, file_path: str) -> Optional[PreparedFile]:
+    """Returns the cached preparation result for a key, or None on a cache miss."""
+    conn = sqlite3.connect(cache_path, timeout=30)
+    try:
+        row = conn.execute("SELECT page_tokens, page_texts, pdf, is_native FROM prepared_files WHERE key = ?",
+                           (key,)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    page_tokens, page_texts, pdf, is_native = row
+    return PreparedFile(filename, pdf_path=file_path if is_native else None, pdf_bytes=pdf,
+                        page_texts=json.loads(page_texts), page_tokens=json.loads(page_tokens),
+                        cache_key=key, from_cache=True)
+
+
+def store_cached_file(conn: sqlite3.Connection, prepared: PreparedFile, cfg: AppConfig):
+    """Saves a freshly prepared file so unchanged sources skip extraction and tokenization next run."""
+    # Page texts are only needed to re-count heuristic batches; otherwise just keep which pages are estimates
+    page_texts = prepared.page_texts if cfg.tokenizer_backend == "heuristic" else \
+        [None if text is None else "" for text in prepared.page_texts]
+    conn.execute("INSERT OR REPLACE INTO prepared_files VALUES (?, ?, ?, ?, ?)",
+                 (prepared.cache_key, json.dumps(prepared.page_tokens), json.dumps(page_texts),
+                  prepared.pdf_bytes, int(prepared.pdf_path is not None)))
+    conn.commit()
+
+
+def prune_cache(conn: sqlite3.Connection, keys: set):
+    """Deletes cached entries for files (or settings) not seen in this run and reclaims their disk space."""
+    conn.execute("CREATE TEMP TABLE seen_keys (key TEXT PRIMARY KEY)")
+    conn.executemany("INSERT OR IGNORE INTO seen_keys VALUES (?)", ((key,) for key in keys))
+    deleted = conn.execute("DELETE FROM prepared_files WHERE key NOT IN (SELECT key FROM seen_keys)").rowcount
+    conn.execute("DROP TABLE seen_keys")
+    conn.commit()
+    if deleted:
+        logging.info(f"Removed {deleted} stale entries from the preparation cache.")
+        conn.execute("VACUUM")
+
+
+def _prepare_file(filename: str, cfg: AppConfig, threads: int) -> PreparedFile:
+    """Prepares a single source file, reusing the cached result when the file and settings are unchanged."""
+    if not cfg.cache_path:
+        return _extract_file(filename, cfg, threads)
+    file_path = os.path.join(cfg.source_directory, filename)
+    key = _cache_key(file_path, cfg)
+    prepared = load_cached_file(cfg.cache_path, key, filename, file_path)
+    if prepared is None:
+        prepared = _extract_file(filename, cfg, threads)
+        prepared.cache_key = key
+    return prepared
+
+
+def _extract_file(filename: str, cfg: AppConfig, threads: int) -> PreparedFile:
+    """Detects, extracts and tokenizes a single source file using up to `threads` cores. Runs in a worker process."""
+    file_path = os.path.join(cfg.source_directory, filename)
+
+    # Determine if the PDF is native text-based or needs conversion
+    is_native_pdf = False
+    page_texts, page_tokens = None, None
+    if file_path.lower().endswith('.pdf'):
+        try:
+            reader = open_pdf_reader(file_path)
+            # Simple heuristic: if we can extract more than a little text from the first few pages, it's native.
+            # Stop as soon as enough text is found; the extracted text is kept so each page is only parsed once.
+            sampled_texts, sampled_chars = {}, 0
+            for i, page in enumerate(reader.pages[:5]):
+                if not _page_may_have_text(page):
+                    continue
+                sampled_texts[i] = page.extract_text() or ""
+                sampled_chars += len(sampled_texts[i])
+                if sampled_chars > 100:
+                    is_native_pdf = True
+                    break
+        except Exception:
+            is_native_pdf = False
+
+        # Extraction of the remaining pages is outside the classification try: a single broken page
+        # must not turn a native PDF into a "scanned" one.
+        if is_native_pdf and cfg.estimate_native_tokens:
+            # Only the sampled pages are extracted; the batching loop counts boundary pages exactly
+            page_texts = [sampled_texts.get(i) for i in range(len(reader.pages))]
+            exact = dict(zip(sampled_texts, count_page_tokens(list(sampled_texts.values()), cfg, threads)))
+            page_tokens = [exact[i] if i in exact else _estimate_page_tokens(p)
+                           for i, p in enumerate(reader.pages)]
+        elif is_native_pdf:
+            page_texts = [sampled_texts[i] if i in sampled_texts else _extract_page_text(p, filename, i)
+                          for i, p in enumerate(reader.pages)]
+
+    # Get the PDF whose pages will be streamed into batches
+    pdf_path, pdf_bytes = None, None
+    if is_native_pdf:
+        pdf_path = file_path
+    else:
+        # For non-native files, convert the entire text to an in-memory PDF
+        if file_path.lower().endswith('.pdf') and not cfg.use_ocr:
+            logging.warning(f"Skipping scanned PDF {filename} because use_ocr is false.")
+            return PreparedFile(filename, skip_reason="Scanned PDF found but OCR is disabled")
+
+        text = extract_text_from_file(file_path, cfg, threads)
+        if not text.strip():
+            return PreparedFile(filename, skip_reason="No text extracted or file is unreadable")
+
+        # Render in memory; the bytes are handed back to the main process without touching disk
+        buffer = io.BytesIO()
+        create_pdf_from_text(text, buffer, cfg.font_path)
+
+        if buffer.getbuffer().nbytes:
+            pdf_bytes = buffer.getvalue()
+            page_texts = [page.extract_text() or "" for page in PdfReader(buffer).pages]
+
+    if not pdf_path and not pdf_bytes:
+        logging.warning(f"Could not create a readable PDF from {filename}. Skipping.")
+        return PreparedFile(filename, skip_reason="Could not create a readable PDF")
+
+    if page_tokens is None:
+        page_tokens = count_page_tokens(page_texts, cfg, threads)
+    return PreparedFile(filename, pdf_path=pdf_path, pdf_bytes=pdf_bytes, page_texts=page_texts,
+                        page_tokens=page_tokens)
+
+
+def _map_bounded(ex, fn, items, *args, window: int):
+    """Like ex.map, but with at most `window` tasks in flight so results can't pile up behind a slow file."""
+    items = iter(items)
+    pending = deque(ex.submit(fn, item, *args) for item in islice(items, window))
+    while pending:
+        result = pending.popleft().result()
+        for item in islice(items, 1):
+            pending.append(ex.submit(fn, item, *args))
+        yield result
 
 
 @hydra.main(config_path="configs", config_name="config", version_base=None)
@@ -177,107 +708,110 @@ def prepare_knowledge_base(cfg: AppConfig):
     if os.path.dirname(cfg.report_path):
         os.makedirs(os.path.dirname(cfg.report_path), exist_ok=True)
 
-    temp_dir = os.path.join(cfg.output_directory, "temp_generated_pdfs")
-    if os.path.exists(temp_dir): shutil.rmtree(temp_dir)
-    os.makedirs(temp_dir)
-
     report = {"merged_files": [], "skipped_files": [], "total_files_processed": 0}
     max_bytes = cfg.max_file_size_mb * 1024 * 1024
 
-    all_files = [f for f in os.listdir(cfg.source_directory) if any(f.lower().endswith(ext) for ext in cfg.file_types)]
-    report["total_files_processed"] = len(all_files)
-
-    # --- Streaming Batch Processing ---
-    batch_writer, batch_tokens, batch_sources, batch_size = PdfWriter(), 0, [], 0
-    merged_file_count = 1
-
-    for filename in sorted(all_files):
-        file_path = os.path.join(cfg.source_directory, filename)
-
-        if os.path.getsize(file_path) > max_bytes:
+    # A single scandir pass filters by extension and size; DirEntry caches the stat result
+    extensions = tuple(ext.lower() for ext in cfg.file_types)
+    with os.scandir(cfg.source_directory) as entries:
+        matched = sorted((e.name, e.stat().st_size) for e in entries
+                         if e.is_file() and e.name.lower().endswith(extensions))
+    all_files = []
+    for filename, file_size in matched:
+        if file_size > max_bytes:
             report["skipped_files"].append(
-                {"file": filename, "reason": f"Exceeds max size of {cfg.max_file_size_mb} MB"})
-            continue
-
-        # Determine if the PDF is native text-based or needs conversion
-        is_native_pdf = False
-        if file_path.lower().endswith('.pdf'):
-            try:
-                reader = PdfReader(file_path)
-                # Simple heuristic: if we can extract more than a little text, it's native.
-                if len("".join(p.extract_text() or "" for p in reader.pages[:5])) > 100:
-                    is_native_pdf = True
-            except Exception:
-                is_native_pdf = False
-
-        # Get a reader object for the page stream
-        reader = None
-        temp_pdf_to_clean = None
-        if is_native_pdf:
-            reader = PdfReader(file_path)
+                {"file": filename,
+                 "reason": f"Exceeds max size of {cfg.max_file_size_mb} MB ({file_size / (1024 * 1024):.2f} MB)"})
         else:
-            # For non-native files, convert the entire text to a temporary PDF
-            if file_path.lower().endswith('.pdf') and not cfg.use_ocr:
-                report["skipped_files"].append({"file": filename, "reason": "Scanned PDF found but OCR is disabled"})
-                logging.warning(f"Skipping scanned PDF {filename} because use_ocr is false.")
-                continue
+            all_files.append(filename)
+    report["total_files_processed"] = len(matched)
 
-            text = extract_text_from_file(file_path, cfg)
-            if not text.strip():
-                report["skipped_files"].append({"file": filename, "reason": "No text extracted or file is unreadable"})
-                continue
-
-            temp_pdf_path = os.path.join(temp_dir, os.path.splitext(filename)[0] + ".pdf")
-            create_pdf_from_text(text, temp_pdf_path)
-
-            if os.path.exists(temp_pdf_path):
-                reader = PdfReader(temp_pdf_path)
-                temp_pdf_to_clean = temp_pdf_path
-
-        if not reader:
-            logging.warning(f"Could not create a readable PDF from {filename}. Skipping.")
-            continue
+    # --- Streaming Batch Processing ---
+    # batch_pages holds (source, page_indices) groups; pages are only copied when the batch is written.
+    # batch_sources is a dict used as an ordered set of contributing filenames.
+    batch_pages, batch_tokens, batch_sources, batch_texts, batch_size = [], 0, {}, [], 0
+    merged_file_count = 1
 
-        # Stream pages from the reader into batches
-        for page in reader.pages:
-            page_text = page.extract_text() or ""
-            page_tokens = count_tokens(page_text, cfg.tiktoken_model)
-
-            # This is a critical edge case. If a single page is larger than the max token limit,
-            # it must be skipped as it cannot be split without losing its format.
-            if page_tokens > cfg.max_tokens_per_file:
-                logging.warning(
-                    f"A single page in '{filename}' has {page_tokens} tokens, which exceeds the limit of {cfg.max_tokens_per_file}. This page will be skipped.")
-                report["skipped_files"].append(
-                    {"file": filename, "reason": f"A single page was too large ({page_tokens} tokens)."})
+    cache = open_cache(cfg.cache_path) if cfg.cache_path else None
+    seen_cache_keys = set()
+
+    # Never start more file workers than there are files, and split the cores evenly between them so that
+    # a few large scanned PDFs still OCR and tokenize on all cores without nested pools oversubscribing.
+    cpu_count = os.cpu_count() or 1
+    workers = max(1, min(cfg.workers or cpu_count, len(all_files)))
+    threads = max(1, cpu_count // workers)
+
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        prepared_files = _map_bounded(ex, _prepare_file, all_files, cfg, threads, window=2 * workers)
+        for prepared in prepared_files:
+            filename = prepared.filename
+            seen_cache_keys.add(prepared.cache_key)
+            if prepared.skip_reason:
+                report["skipped_files"].append({"file": filename, "reason": prepared.skip_reason})
                 continue
-
-            # If the current page doesn't fit, finalize the current batch and start a new one
-            if batch_writer.pages and (batch_tokens + page_tokens > cfg.max_tokens_per_file):
-                batch_writer, batch_tokens, batch_sources, batch_size = finalize_batch(
-                    batch_writer, batch_tokens, batch_sources, batch_size, merged_file_count, cfg, report
-                )
-                merged_file_count += 1
-
-            # Add the page to the current batch
-            batch_writer.add_page(page)
-            batch_tokens += page_tokens
-            batch_sources.append(filename)
-            # Note: We don't track batch_size here as it's complex. The initial file size check is the main guard.
-
-        if temp_pdf_to_clean:
-            # We need to close the reader before deleting the file on Windows
-            reader.stream.close()
-            os.remove(temp_pdf_to_clean)
+            if cache is not None and not prepared.from_cache:
+                # Only the main process writes to the cache; workers just read from it.
+                # Skipped files are not cached so they are retried once e.g. a missing dependency is installed.
+                store_cached_file(cache, prepared, cfg)
+
+            source = prepared.pdf_bytes or prepared.pdf_path
+            reader = None
+            for page_index, (page_text, page_tokens) in enumerate(zip(prepared.page_texts, prepared.page_tokens)):
+
+                # Estimated pages are counted exactly when they are close to deciding whether the batch is full
+                if page_text is None and batch_tokens + page_tokens >= 0.9 * cfg.max_tokens_per_file:
+                    if reader is None:
+                        reader = open_pdf_reader(prepared.pdf_path)
+                    page_text = _extract_page_text(reader.pages[page_index], filename, page_index)
+                    page_tokens = count_page_tokens([page_text], cfg)[0]
+
+                # This is a critical edge case. If a single page is larger than the max token limit,
+                # it must be skipped as it cannot be split without losing its format.
+                if page_tokens > cfg.max_tokens_per_file:
+                    logging.warning(
+                        f"A single page in '{filename}' has {page_tokens} tokens, which exceeds the limit of {cfg.max_tokens_per_file}. This page will be skipped.")
+                    report["skipped_files"].append(
+                        {"file": filename, "reason": f"A single page was too large ({page_tokens} tokens)."})
+                    continue
+
+                # If the current page doesn't fit, finalize the current batch and start a new one
+                if batch_pages and (batch_tokens + page_tokens > cfg.max_tokens_per_file):
+                    batch_pages, batch_tokens, batch_sources, batch_texts, batch_size = finalize_batch(
+                        batch_pages, batch_tokens, batch_sources, batch_texts, batch_size, merged_file_count, cfg,
+                        report, threads
+                    )
+                    merged_file_count += 1
+
+                # Add the page to the current batch
+                if batch_pages and batch_pages[-1][0] is source:
+                    batch_pages[-1][1].append(page_index)
+                else:
+                    batch_pages.append((source, [page_index]))
+                batch_tokens += page_tokens
+                batch_sources.setdefault(filename, None)
+                batch_texts.append((page_text, page_tokens))
+                # Note: We don't track batch_size here as it's complex. The initial file size check is the main guard.
+
+            if reader is not None:
+                # Release the memory map opened for the exact re-count; batches are merged from the path
+                reader.stream.close()
+
+    if cache is not None:
+        prune_cache(cache, seen_cache_keys)
+        cache.close()
 
     # Finalize the very last batch
-    if batch_writer.pages:
-        finalize_batch(batch_writer, batch_tokens, batch_sources, batch_size, merged_file_count, cfg, report)
-
-    # --- Finalize and clean up ---
-    shutil.rmtree(temp_dir)
-    with open(cfg.report_path, 'w') as f:
-        json.dump(report, f, indent=4)
+    if batch_pages:
+        finalize_batch(batch_pages, batch_tokens, batch_sources, batch_texts, batch_size, merged_file_count, cfg,
+                       report, threads)
+
+    # --- Write the report ---
+    if ORJSON_ENABLED:
+        with open(cfg.report_path, 'wb') as f:
+            f.write(orjson.dumps(report, option=orjson.OPT_INDENT_2))
+    else:
+        with open(cfg.report_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
 
     logging.info(f"Knowledge base preparation complete. Report generated at {cfg.report_path}")
 